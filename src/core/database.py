@@ -1,14 +1,15 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from typing import Optional
-from pymongo import IndexModel, ASCENDING, DESCENDING, ReadPreference, WriteConcern
+from pymongo import IndexModel, ASCENDING, DESCENDING, ReadPreference, WriteConcern, monitoring
 from dotenv import load_dotenv
 from pymongo.server_api import ServerApi
 import logging
 import dns.resolver
-from pymongo.errors import ConfigurationError, ConnectionFailure
+from pymongo.errors import ConfigurationError, ConnectionFailure, OperationFailure
 import time
 import asyncio
+import random
 from contextlib import asynccontextmanager
 
 # Configure logging
@@ -27,118 +28,207 @@ if not MONGO_URL:
 dns.resolver.default_resolver = dns.resolver.Resolver(configure=True)
 dns.resolver.default_resolver.nameservers = ['8.8.8.8', '8.8.4.4']  # Use Google's DNS servers
 
-# Global variables
-client: Optional[AsyncIOMotorClient] = None
-db = None
-messages_collection = None
-groups_collection = None
-is_initialized = False
-
-async def get_db():
-    """Get database instance, initializing if necessary"""
-    global is_initialized
-    if not is_initialized:
-        await init_db()
-    return db
-
-async def get_messages_collection():
-    """Get messages collection, initializing if necessary"""
-    global messages_collection
-    if not is_initialized:
-        await init_db()
-    if messages_collection is None:
-        raise ConnectionError("Database not properly initialized")
-    return messages_collection
-
-async def get_groups_collection():
-    """Get groups collection, initializing if necessary"""
-    global groups_collection
-    if not is_initialized:
-        await init_db()
-    if groups_collection is None:
-        raise ConnectionError("Database not properly initialized")
-    return groups_collection
+# Connection pool sizing (per worker process); keep MAX_POOL_SIZE * workers
+# within the cluster's connection limit
+MAX_POOL_SIZE = int(os.getenv("MAX_POOL_SIZE", "200"))
+MIN_POOL_SIZE = int(os.getenv("MIN_POOL_SIZE", "20"))
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Tracks connection pool usage for the pool health endpoint"""
+
+    def __init__(self):
+        self.stats = {
+            "open_connections": 0,
+            "checked_out": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "pool_clears": 0
+        }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.stats["pool_clears"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.stats["open_connections"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.stats["open_connections"] -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.stats["checkout_failures"] += 1
+
+    def connection_checked_out(self, event):
+        self.stats["checked_out"] += 1
+        self.stats["checkouts"] += 1
+
+    def connection_checked_in(self, event):
+        self.stats["checked_out"] -= 1
+
+pool_stats = PoolStatsListener()
+
+# Retries for building the client (mongodb+srv URIs resolve SRV/TXT records in the constructor)
+CLIENT_CREATE_RETRIES = 5
+
+def _create_client() -> AsyncIOMotorClient:
+    """Build the client, retrying transient DNS failures during SRV resolution.
+
+    Runs at import, before there's an event loop, so it backs off with time.sleep
+    using the same jittered schedule as connect_db.
+    """
+    for attempt in range(CLIENT_CREATE_RETRIES):
+        try:
+            return _build_client()
+        except ConfigurationError as e:
+            if attempt == CLIENT_CREATE_RETRIES - 1:
+                logger.error(f"Failed to create MongoDB client after {CLIENT_CREATE_RETRIES} attempts")
+                raise
+            logger.warning(f"MongoDB client creation attempt {attempt + 1} failed: {str(e)}")
+            time.sleep(min(30, 2 ** attempt) * (0.5 + random.random() * 0.5))
+
+def _build_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        MONGO_URL,
+        server_api=ServerApi('1'),
+        maxPoolSize=MAX_POOL_SIZE,
+        minPoolSize=MIN_POOL_SIZE,
+        maxIdleTimeMS=30000,
+        connectTimeoutMS=20000,
+        serverSelectionTimeoutMS=3000,  # Fail fast instead of piling up waiters
+        socketTimeoutMS=30000,
+        waitQueueTimeoutMS=2000,  # Fail fast (503) when the pool is exhausted
+        retryWrites=True,
+        retryReads=True,
+        maxConnecting=5,
+        appName='chatapp',
+        heartbeatFrequencyMS=10000,
+        localThresholdMS=15000,
+        compressors='zstd,zlib',
+        directConnection=False,
+        event_listeners=[pool_stats]
+    )
+
+# The driver connects lazily on the first command and manages pool readiness,
+# so the client and collections are built once at import and used directly.
+client = _create_client()
+db = client.get_database('chatapp')
+messages_collection = db.get_collection(
+    'messages',
+    read_preference=ReadPreference.PRIMARY_PREFERRED,
+    write_concern=WriteConcern(w=1, wtimeout=20000)
+)
+groups_collection = db.get_collection(
+    'groups',
+    read_preference=ReadPreference.PRIMARY_PREFERRED,
+    write_concern=WriteConcern(w=1, wtimeout=20000)
+)
+
+# Background conversation_id backfill started by init_db (kept referenced so it isn't collected)
+_backfill_task: Optional[asyncio.Task] = None
 
 async def init_db():
-    global client, db, messages_collection, groups_collection, is_initialized
-    
-    if is_initialized:
-        return
-    
+    """Verify connectivity and create indexes at startup"""
     try:
-        # Create client with the current event loop
-        client = AsyncIOMotorClient(
-            MONGO_URL,
-            server_api=ServerApi('1'),
-            maxPoolSize=50,
-            minPoolSize=10,
-            maxIdleTimeMS=30000,
-            connectTimeoutMS=20000,
-            serverSelectionTimeoutMS=20000,
-            socketTimeoutMS=30000,
-            waitQueueTimeoutMS=20000,
-            waitQueueMultiple=3,
-            retryWrites=True,
-            retryReads=True,
-            maxConnecting=5,
-            appName='chatapp',
-            heartbeatFrequencyMS=10000,
-            localThresholdMS=15000,
-            compressors='zlib',
-            zlibCompressionLevel=3,
-            directConnection=False
-        )
-        
         # Test the connection
         await client.admin.command('ping')
         logger.info("Successfully connected to MongoDB")
-        
-        # Initialize database and collections
-        db = client.get_database('chatapp')
-        messages_collection = db.get_collection(
-            'messages',
-            read_preference=ReadPreference.PRIMARY_PREFERRED,
-            write_concern=WriteConcern(w=1, wtimeout=20000)
-        )
-        groups_collection = db.get_collection(
-            'groups',
-            read_preference=ReadPreference.PRIMARY_PREFERRED,
-            write_concern=WriteConcern(w=1, wtimeout=20000)
+        pool_options = client.delegate.options.pool_options
+        logger.info(
+            f"MongoDB pool sizing: maxPoolSize={pool_options.max_pool_size}, "
+            f"minPoolSize={pool_options.min_pool_size}, maxConnecting={pool_options.max_connecting}"
         )
-        
+
         # Initialize indexes
         await init_indexes()
-        is_initialized = True
+
+        # Data migration runs in the background; startup doesn't depend on it
+        global _backfill_task
+        _backfill_task = asyncio.create_task(backfill_conversation_ids())
         logger.info("Database initialization completed successfully")
-        
+
     except Exception as e:
         logger.error(f"Error initializing MongoDB client: {str(e)}")
-        if client:
-            client.close()
-            client = None
-        db = None
-        messages_collection = None
-        groups_collection = None
-        is_initialized = False
         raise
 
+async def backfill_conversation_ids():
+    """Add conversation_id to direct messages stored before it existed"""
+    try:
+        # Same key as core.models.direct_conversation_id: $min/$max order strings
+        # by binary comparison like sorted(), and $strLenCP counts code points like len()
+        result = await messages_collection.update_many(
+            {
+                "type": "direct",
+                "conversation_id": {"$exists": False},
+                # Legacy documents stored the recipient unvalidated; skip non-string ids
+                "from_user_id": {"$type": "string"},
+                "to_user_id": {"$type": "string"},
+            },
+            [{"$set": {"conversation_id": {"$let": {
+                "vars": {
+                    "low": {"$min": ["$from_user_id", "$to_user_id"]},
+                    "high": {"$max": ["$from_user_id", "$to_user_id"]},
+                },
+                "in": {"$concat": [
+                    {"$toString": {"$strLenCP": "$$low"}}, ":", "$$low", ":", "$$high"
+                ]},
+            }}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Backfilled conversation_id on {result.modified_count} direct messages")
+    except Exception as e:
+        logger.error(f"Error backfilling conversation ids: {str(e)}")
+
+# Indexes from earlier schemas that no query uses anymore; dropped so inserts stop maintaining them
+LEGACY_MESSAGE_INDEXES = (
+    "user_messages",
+    "group_messages",
+    "message_timestamp",
+    "message_type_status",
+    "message_read_by",
+    "direct_conversation",
+    "direct_history",
+)
+
+async def _drop_index_if_exists(collection, name: str):
+    try:
+        await collection.drop_index(name)
+        logger.info(f"Dropped legacy index {name}")
+    except OperationFailure as e:
+        if e.code != 27:  # IndexNotFound
+            raise
+
+async def drop_legacy_indexes():
+    """Drop indexes replaced by the current set"""
+    await asyncio.gather(*(
+        _drop_index_if_exists(messages_collection, name) for name in LEGACY_MESSAGE_INDEXES
+    ))
+
 async def init_indexes():
     """Initialize database indexes"""
     try:
         # Indexes for messages collection
         message_indexes = [
-            IndexModel([("from_user_id", ASCENDING), ("to_user_id", ASCENDING)], 
-                      name="user_messages"),
-            IndexModel([("group_id", ASCENDING)], 
-                      name="group_messages"),
-            IndexModel([("timestamp", DESCENDING)], 
-                      name="message_timestamp"),
-            IndexModel([("type", ASCENDING), ("status", ASCENDING)], 
-                      name="message_type_status"),
-            IndexModel([("read_by", ASCENDING)], 
-                      name="message_read_by"),
+            IndexModel([("conversation_id", ASCENDING), ("timestamp", DESCENDING)], 
+                      name="direct_conversation_id"),
+            IndexModel([("group_id", ASCENDING), ("timestamp", DESCENDING)], 
+                      name="group_history"),
+            IndexModel([("type", ASCENDING), ("to_user_id", ASCENDING), ("status", ASCENDING)], 
+                      name="unread_direct"),
         ]
-        await messages_collection.create_indexes(message_indexes)
 
         # Indexes for groups collection
         group_indexes = [
@@ -149,7 +239,14 @@ async def init_indexes():
             IndexModel([("name", ASCENDING)], 
                       name="group_name")
         ]
-        await groups_collection.create_indexes(group_indexes)
+
+        # Build both collections' indexes concurrently. Index builds on MongoDB 4.2+
+        # no longer hold an exclusive lock, so no background option is needed.
+        await asyncio.gather(
+            messages_collection.create_indexes(message_indexes),
+            groups_collection.create_indexes(group_indexes)
+        )
+        await drop_legacy_indexes()
         logger.info("Database indexes created successfully")
         
     except Exception as e:
@@ -173,8 +270,7 @@ async def get_db_stats():
 
 async def connect_db():
     """Initialize database connection with retries"""
-    max_retries = 3
-    retry_delay = 2
+    max_retries = 5
     
     for attempt in range(max_retries):
         try:
@@ -185,16 +281,19 @@ async def connect_db():
                 logger.error(f"Failed to connect to database after {max_retries} attempts")
                 raise
             logger.warning(f"Database connection attempt {attempt + 1} failed: {str(e)}")
-            await asyncio.sleep(retry_delay * (attempt + 1))
+            # Capped exponential backoff with jitter so workers don't retry in lockstep
+            delay = min(30, 2 ** attempt) * (0.5 + random.random() * 0.5)
+            await asyncio.sleep(delay)
 
 async def close_db():
     """Close database connection"""
-    global client, db, messages_collection, groups_collection, is_initialized
-    if client:
-        client.close()
-        client = None
-        db = None
-        messages_collection = None
-        groups_collection = None
-        is_initialized = False
-        logger.info("MongoDB connection closed")
\ No newline at end of file
+    client.close()
+    logger.info("MongoDB connection closed")
+
+def get_pool_stats():
+    """Get connection pool sizing and usage"""
+    return {
+        "max_pool_size": MAX_POOL_SIZE,
+        "min_pool_size": MIN_POOL_SIZE,
+        **pool_stats.stats
+    }
@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+from typing import Dict, Set, Tuple
+from bson import ObjectId
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+from core.database import groups_collection
+
+logger = logging.getLogger(__name__)
+
+# Shared across workers when REDIS_URL is set, otherwise cached per process
+REDIS_URL = os.getenv("REDIS_URL")
+MEMBERSHIP_TTL = 60  # seconds; explicit invalidation covers membership changes
+MAX_CACHED_GROUPS = 10_000  # per-process fallback only
+GENERATION_TTL = 86400  # seconds; far longer than any load, so a generation can't repeat mid-load
+
+redis = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# group id -> (expires_at, members). Fixed TTL, so insertion order is expiry order.
+_local_members: Dict[str, Tuple[float, Set[str]]] = {}
+# Bumped by every local invalidation; a load that straddles one isn't cached
+_local_generation = 0
+
+
+def _members_key(group_id: str) -> str:
+    return f"group:{group_id}:members"
+
+
+def _generation_key(group_id: str) -> str:
+    return f"group:{group_id}:gen"
+
+
+async def get_member_ids(group_id) -> Set[str]:
+    """Get a group's member ids, loading from MongoDB on a cache miss"""
+    group_id = str(group_id)
+
+    if redis is not None:
+        members = await redis.smembers(_members_key(group_id))
+        if members:
+            return members
+        generation = await redis.get(_generation_key(group_id))
+    else:
+        cached = _local_members.get(group_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        generation = _local_generation
+
+    group = await groups_collection.find_one({"_id": ObjectId(group_id)}, {"member_ids": 1})
+    members = set(group["member_ids"]) if group else set()
+    # Don't cache misses: ids come from clients, and unknown groups would pile up
+    if not members:
+        return members
+
+    if redis is not None:
+        await _store_redis(group_id, members, generation)
+    elif generation == _local_generation:
+        _local_members.pop(group_id, None)
+        _local_members[group_id] = (time.monotonic() + MEMBERSHIP_TTL, members)
+        now = time.monotonic()
+        while _local_members:
+            oldest, (expires_at, _) = next(iter(_local_members.items()))
+            if expires_at > now and len(_local_members) <= MAX_CACHED_GROUPS:
+                break
+            del _local_members[oldest]
+    return members
+
+
+async def _store_redis(group_id: str, members: Set[str], generation) -> None:
+    """Cache members unless the group was invalidated while they were being loaded"""
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(_generation_key(group_id))
+            if await pipe.get(_generation_key(group_id)) != generation:
+                return  # Loaded before a membership change; the next read reloads
+            pipe.multi()
+            pipe.sadd(_members_key(group_id), *members)
+            pipe.expire(_members_key(group_id), MEMBERSHIP_TTL)
+            await pipe.execute()
+        except WatchError:
+            pass
+
+
+async def is_member(group_id, user_id: str) -> bool:
+    """Check whether a user belongs to a group"""
+    if redis is not None:
+        # O(1) membership test; EXISTS tells a cache miss apart from a non-member
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.sismember(_members_key(str(group_id)), user_id)
+            pipe.exists(_members_key(str(group_id)))
+            member, cached = await pipe.execute()
+        if cached:
+            return bool(member)
+    return user_id in await get_member_ids(group_id)
+
+
+async def invalidate_group(group_id) -> None:
+    """Drop cached membership after members are added/removed or the group is deleted"""
+    global _local_generation
+    group_id = str(group_id)
+    try:
+        if redis is not None:
+            # Bump the generation so in-flight loads of the old member list aren't stored
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.incr(_generation_key(group_id))
+                pipe.expire(_generation_key(group_id), GENERATION_TTL)
+                pipe.delete(_members_key(group_id))
+                await pipe.execute()
+        else:
+            _local_generation += 1
+            _local_members.pop(group_id, None)
+    except Exception as e:
+        logger.error(f"Error invalidating membership cache for group {group_id}: {str(e)}")
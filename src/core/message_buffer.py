@@ -1,155 +1,292 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Deque, Set
 import asyncio
-from datetime import datetime, UTC
-from core.database import get_messages_collection
+from contextlib import suppress
+from collections import deque
+from itertools import islice
+from datetime import datetime, timedelta, UTC
+import time
+import random
+from core.database import messages_collection
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
-import backoff
+import aiofiles
+from bson import encode
+from bson.raw_bson import RawBSONDocument
 from pymongo.errors import (
     ConnectionFailure, 
     OperationFailure, 
     ServerSelectionTimeoutError,
-    NetworkTimeout
+    NetworkTimeout,
+    BulkWriteError
 )
 from pymongo.write_concern import WriteConcern
+from pymongo import InsertOne
+
+# Upper bound on ops per bulk_write call when flushing a large backlog
+MAX_BULK_CHUNK = 1000
+
+RETRYABLE_ERRORS = (ConnectionFailure, OperationFailure, ServerSelectionTimeoutError, NetworkTimeout)
 
 class CircuitBreaker:
-    def __init__(self, failure_threshold=5, reset_timeout=30):
+    def __init__(self, failure_threshold=5, reset_timeout=30, max_reset_timeout=300):
         self.failure_count = 0
         self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
         self.reset_timeout = reset_timeout
-        self.last_failure_time = None
-        self.is_open = False
-        
+        self.max_reset_timeout = max_reset_timeout
+        self.last_failure_time: float = 0.0  # time.monotonic() of the last failure
+        self.state: str = "closed"  # closed, open or half_open
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != "closed"
+
     def record_failure(self):
         self.failure_count += 1
-        self.last_failure_time = datetime.now(UTC)
-        if self.failure_count >= self.failure_threshold:
-            self.is_open = True
-            
+        self.last_failure_time = time.monotonic()
+        if self.state == "half_open":
+            # Probe failed: re-open and wait longer before the next one
+            self.state = "open"
+            self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+        elif self.failure_count >= self.failure_threshold:
+            self.state = "open"
+
     def record_success(self):
         self.failure_count = 0
-        self.is_open = False
-        
+        self.state = "closed"
+        self.reset_timeout = self.base_reset_timeout
+
+    def release_probe(self):
+        """Re-open if a probe ended without an outcome (e.g. it was cancelled)"""
+        if self.state == "half_open":
+            self.state = "open"
+            self.last_failure_time = time.monotonic()
+
+    def probe_due(self) -> bool:
+        """Whether an open breaker has waited long enough to allow a probe"""
+        return (
+            self.state == "open"
+            and time.monotonic() - self.last_failure_time > self.reset_timeout
+        )
+
     def can_proceed(self) -> bool:
-        if not self.is_open:
+        if self.state == "closed":
             return True
-        
-        if (datetime.now(UTC) - self.last_failure_time).total_seconds() > self.reset_timeout:
-            self.failure_count = 0
-            self.is_open = False
+
+        if self.probe_due():
+            # Let exactly one probe through; its outcome closes or re-opens the breaker
+            self.state = "half_open"
             return True
-            
+
         return False
 
 class MessageBuffer:
-    def __init__(self, batch_size=10, flush_interval=2.0, max_retries=2):
-        self.messages: List[Dict] = []
+    def __init__(self, batch_size=10, flush_interval=2.0, max_retries=2,
+                 max_buffer=10_000, spool_path="message_spool.bson"):
+        self.messages: Deque[RawBSONDocument] = deque()
+        self.max_buffer = max_buffer
+        self.spool_path = spool_path  # Overflow that couldn't be requeued is appended here as raw BSON
         self.batch_size = batch_size
         self.flush_interval = flush_interval
         self.lock = asyncio.Lock()
-        self.last_flush = datetime.now(UTC)
+        self._flush_task: Optional[asyncio.Task] = None  # flush kicked off by add_message
+        self._periodic_task: Optional[asyncio.Task] = None
+        self._pending_flushes: Set[asyncio.Task] = set()  # every in-flight flush, awaited on close
+        self.last_flush = time.monotonic()
         self.max_retries = max_retries
+        self._flushes_since_grow = 0  # successful flushes since the last batch size increase
         self.circuit_breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
         self.write_concern = WriteConcern(w=1, wtimeout=20000)
+        self._wc_collection = messages_collection.with_options(
+            write_concern=self.write_concern
+        )
         self.stats = {
             "total_messages": 0,
             "successful_flushes": 0,
             "failed_flushes": 0,
             "retry_count": 0,
-            "circuit_breaker_trips": 0
+            "circuit_breaker_trips": 0,
+            "dropped_messages": 0,
+            "spooled_messages": 0
         }
         
     async def add_message(self, message: Dict) -> None:
+        # Encode to BSON once up front so the driver doesn't re-encode on insert.
+        # Messages carry their own _id, so the driver has nothing to add to the raw document.
+        document = RawBSONDocument(encode(message))
         async with self.lock:
-            self.messages.append(message)
+            # Shed load instead of growing without bound while the database is unreachable
+            if len(self.messages) >= self.max_buffer and self.circuit_breaker.is_open:
+                keep = self.max_buffer // 2
+                for _ in range(len(self.messages) - keep):
+                    self.messages.popleft()
+                    self.stats["dropped_messages"] += 1
+                logging.warning(f"Message buffer full, dropped oldest messages down to {keep}")
+            self.messages.append(document)
             self.stats["total_messages"] += 1
-            
-            # Check if we should flush based on batch size
-            if len(self.messages) >= self.batch_size:
-                await self.flush()
-
-    @backoff.on_exception(
-        backoff.expo,
-        (ConnectionFailure, OperationFailure, ServerSelectionTimeoutError, NetworkTimeout),
-        max_tries=2,
-        max_time=10
-    )                
-    async def _perform_bulk_insert(self, messages_to_flush: List[Dict]) -> bool:
-        if not self.circuit_breaker.can_proceed():
-            logging.warning("Circuit breaker is open, skipping database operation")
-            return False
-            
+            should_flush = len(self.messages) >= self.batch_size
+
+        # Flush in the background so the producer never waits on the database
+        if should_flush and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = self._start_flush()
+
+    def _start_flush(self) -> asyncio.Task:
+        """Run a flush as a tracked task so close() can wait for it"""
+        task = asyncio.create_task(self.flush())
+        self._pending_flushes.add(task)
+        task.add_done_callback(self._pending_flushes.discard)
+        return task
+
+    async def _perform_bulk_insert(self, messages_to_flush: Deque[RawBSONDocument]) -> bool:
+        ops = [InsertOne(m) for m in messages_to_flush]
+        # Large backlogs (e.g. after an outage) go out as concurrent chunks over the pool
+        chunks = [ops[i:i + MAX_BULK_CHUNK] for i in range(0, len(ops), MAX_BULK_CHUNK)]
+
+        for attempt in range(self.max_retries):
+            if not self.circuit_breaker.can_proceed():
+                logging.warning("Circuit breaker is open, skipping database operation")
+                return False
+
+            try:
+                await asyncio.gather(*(self._bulk_insert_chunk(chunk) for chunk in chunks))
+                self.circuit_breaker.record_success()
+                return True
+            except Exception as e:
+                logging.error(f"Bulk insert error: {str(e)}")
+                self.circuit_breaker.record_failure()
+                self.stats["circuit_breaker_trips"] += 1
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt == self.max_retries - 1:
+                    raise
+                self.stats["retry_count"] += 1
+                # Exponential backoff with jitter
+                await asyncio.sleep(min(10, 2 ** attempt) * (0.5 + random.random() * 0.5))
+            except asyncio.CancelledError:
+                # Skips both outcomes above; don't leave the breaker half-open
+                self.circuit_breaker.release_probe()
+                raise
+
+        return False
+
+    async def _bulk_insert_chunk(self, ops: List[InsertOne]) -> None:
         try:
-            messages_collection = await get_messages_collection()
-            # Smaller chunks for free tier
-            chunk_size = 5
-            for i in range(0, len(messages_to_flush), chunk_size):
-                chunk = messages_to_flush[i:i + chunk_size]
-                # Use proper WriteConcern instance
-                await messages_collection.with_options(
-                    write_concern=self.write_concern
-                ).insert_many(
-                    chunk,
-                    ordered=False
-                )
-            self.circuit_breaker.record_success()
-            return True
-        except Exception as e:
-            logging.error(f"Bulk insert error: {str(e)}")
-            self.circuit_breaker.record_failure()
-            self.stats["circuit_breaker_trips"] += 1
-            raise
-                
+            await self._wc_collection.bulk_write(
+                ops,
+                ordered=False,
+                bypass_document_validation=True
+            )
+        except BulkWriteError as e:
+            # Messages carry their own _id, so duplicate key errors just mean an
+            # earlier (partially failed) attempt already inserted them
+            details = e.details
+            if details.get("writeConcernErrors") or any(
+                err.get("code") != 11000 for err in details.get("writeErrors", [])
+            ):
+                raise
+
     async def flush(self) -> None:
+        # Only hold the lock long enough to swap the buffer out
         async with self.lock:
             if not self.messages:
                 return
-                
-            try:
-                # Create a copy of messages to flush and clear buffer
-                messages_to_flush = self.messages.copy()
-                self.messages.clear()
-                
-                # Attempt bulk insert with retries
-                success = await self._perform_bulk_insert(messages_to_flush)
-                
-                if success:
-                    self.last_flush = datetime.now(UTC)
-                    self.stats["successful_flushes"] += 1
-                else:
+            # O(1) handoff of the whole deque, no copy
+            messages_to_flush, self.messages = self.messages, deque()
+
+        try:
+            # Attempt bulk insert with retries
+            success = await self._perform_bulk_insert(messages_to_flush)
+
+            if success:
+                self.last_flush = time.monotonic()
+                self.stats["successful_flushes"] += 1
+                self._flushes_since_grow += 1
+            else:
+                async with self.lock:
                     self.stats["failed_flushes"] += 1
-                    # On complete failure, add messages back to buffer
-                    self.messages.extend(messages_to_flush)
-                    
-            except Exception as e:
+                    # On complete failure, put messages back at the front of the buffer
+                    overflow = self._requeue(messages_to_flush)
+                await self._spool(overflow)
+
+        except Exception as e:
+            logging.error(f"Error flushing messages: {str(e)}")
+            async with self.lock:
                 self.stats["failed_flushes"] += 1
-                logging.error(f"Error flushing messages: {str(e)}")
-                # On error, add messages back to buffer
-                self.messages.extend(messages_to_flush)
-                # Reduce batch size temporarily if we're having issues
-                self.batch_size = max(10, self.batch_size // 2)
+                # On error, put messages back at the front of the buffer
+                overflow = self._requeue(messages_to_flush)
+                # Back off multiplicatively (gentler than halving to avoid thrashing)
+                self.batch_size = max(10, int(self.batch_size * 0.7))
+                self._flushes_since_grow = 0
+            await self._spool(overflow)
+
+    def _requeue(self, batch: Deque[RawBSONDocument]) -> List[RawBSONDocument]:
+        """Put a failed batch back at the front of the buffer, up to max_buffer.
+
+        Must be called with the lock held. Returns the messages that didn't fit.
+        """
+        room = max(0, self.max_buffer - len(self.messages))
+        self.messages.extendleft(reversed(list(islice(batch, room))))
+        return list(islice(batch, room, None))
+
+    async def _spool(self, overflow: List[RawBSONDocument]) -> None:
+        """Append messages that couldn't be buffered to the local spool file"""
+        if not overflow:
+            return
+        try:
+            async with aiofiles.open(self.spool_path, "ab") as f:
+                await f.write(b"".join(m.raw for m in overflow))
+            self.stats["spooled_messages"] += len(overflow)
+            logging.warning(f"Spooled {len(overflow)} messages to {self.spool_path}")
+        except Exception as e:
+            self.stats["dropped_messages"] += len(overflow)
+            logging.error(f"Error spooling messages, dropped {len(overflow)}: {str(e)}")
 
     async def start_periodic_flush(self) -> None:
         while True:
             try:
                 await asyncio.sleep(self.flush_interval)
-                if self.circuit_breaker.can_proceed():
-                    await self.flush()
-                    # Gradually increase batch size back to original if we're successful
-                    if self.stats["successful_flushes"] > 5:
-                        self.batch_size = min(50, self.batch_size + 5)
+                # Don't consume the half-open probe here; _perform_bulk_insert does that
+                if not self.circuit_breaker.is_open or self.circuit_breaker.probe_due():
+                    # Shielded so stopping the loop never abandons a batch mid-insert
+                    await asyncio.shield(self._start_flush())
+                    # Double the batch size after a run of successful flushes
+                    if self._flushes_since_grow > 5:
+                        self.batch_size = min(500, self.batch_size * 2)
+                        self._flushes_since_grow = 0
             except Exception as e:
                 logging.error(f"Error in periodic flush: {str(e)}")
 
+    def start(self) -> None:
+        """Start the periodic flush loop"""
+        self._periodic_task = asyncio.create_task(self.start_periodic_flush())
+
+    async def close(self) -> None:
+        """Stop the periodic flush, wait for in-flight flushes, then flush what's left"""
+        if self._periodic_task is not None:
+            self._periodic_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._periodic_task
+            self._periodic_task = None
+
+        # Batches already swapped out may be requeued if their insert fails
+        if self._pending_flushes:
+            await asyncio.gather(*self._pending_flushes, return_exceptions=True)
+        await self.flush()
+
+        # Whatever still couldn't be written goes to the spool rather than being lost on exit
+        async with self.lock:
+            remaining, self.messages = list(self.messages), deque()
+        await self._spool(remaining)
+
     def get_stats(self) -> Dict:
         """Get current buffer statistics"""
+        since_flush = time.monotonic() - self.last_flush
         return {
             **self.stats,
             "current_buffer_size": len(self.messages),
             "current_batch_size": self.batch_size,
-            "last_flush": self.last_flush.isoformat(),
-            "circuit_breaker_status": "open" if self.circuit_breaker.is_open else "closed",
+            "last_flush": (datetime.now(UTC) - timedelta(seconds=since_flush)).isoformat(),
+            "seconds_since_flush": round(since_flush, 3),
+            "circuit_breaker_status": self.circuit_breaker.state,
+            "circuit_breaker_reset_timeout": self.circuit_breaker.reset_timeout,
             "failure_count": self.circuit_breaker.failure_count
         }
 
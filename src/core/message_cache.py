@@ -0,0 +1,59 @@
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+from core.models import direct_conversation_id
+
+# Short-lived, per-process cache of chat history responses. Writes in this
+# process invalidate the conversation; the TTL bounds staleness from other workers.
+MESSAGE_CACHE_TTL = 2.0  # seconds
+MAX_CACHED_ENTRIES = 10_000
+
+# (conversation key, request key) -> (expires_at, payload). Every entry gets the
+# same TTL, so write order is expiry order and the oldest entries sit at the front.
+_entries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+# conversation key -> request keys cached for it, for invalidation
+_by_conversation: Dict[str, Set[str]] = {}
+
+
+def conversation_key(message_type: str, user_id: str, other_id) -> str:
+    """Key shared by both sides of a direct chat, or by every member of a group"""
+    if message_type == "group":
+        return f"group:{other_id}"
+    return "direct:" + direct_conversation_id(user_id, str(other_id))
+
+
+def get(conversation: str, key: str) -> Optional[Any]:
+    """Return a cached payload, or None if it is missing or expired"""
+    entry = _entries.get((conversation, key))
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+
+def put(conversation: str, key: str, payload: Any) -> None:
+    """Cache a payload, pruning expired entries and evicting the oldest when full"""
+    now = time.monotonic()
+    _discard(conversation, key)
+    _entries[(conversation, key)] = (now + MESSAGE_CACHE_TTL, payload)
+    _by_conversation.setdefault(conversation, set()).add(key)
+
+    while _entries:
+        oldest, (expires_at, _) = next(iter(_entries.items()))
+        if expires_at > now and len(_entries) <= MAX_CACHED_ENTRIES:
+            break
+        _discard(*oldest)
+
+
+def invalidate(conversation: str) -> None:
+    """Drop every cached response for a conversation after it changes"""
+    for key in _by_conversation.pop(conversation, ()):
+        _entries.pop((conversation, key), None)
+
+
+def _discard(conversation: str, key: str) -> None:
+    if _entries.pop((conversation, key), None) is None:
+        return
+    keys = _by_conversation.get(conversation)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _by_conversation[conversation]
@@ -1,8 +1,9 @@
 from datetime import datetime, UTC
 from typing import List, Optional, Union, Dict
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from bson import ObjectId
-import json
+import orjson
+from fastapi.responses import JSONResponse
 from enum import Enum
 
 class MessageType(str, Enum):
@@ -23,37 +24,62 @@ class MessageBase(BaseModel):
 class Message(MessageBase):
     from_user_id: str
     timestamp: datetime
-    id: str = Field(default_factory=lambda: str(ObjectId()))
+    id: ObjectId = Field(default_factory=ObjectId, alias="_id")  # Stored natively as the document _id
     status: str = "sent"  # sent, delivered, read
     read_by: List[str] = []  # List of user IDs who have read the message
     deleted_for: List[str] = []  # List of user IDs who have deleted this message
-    
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat(),
-            ObjectId: str
-        }
+
+    model_config = {"arbitrary_types_allowed": True, "populate_by_name": True}
+
+def direct_conversation_id(user_a: str, user_b: str) -> str:
+    """Order-independent key for a direct chat, stored on each direct message"""
+    low, high = sorted((user_a, user_b))
+    # Length-prefix the first id so ids containing ":" can't make two chats collide
+    return f"{len(low)}:{low}:{high}"
+
+MAX_GROUP_MEMBERS = 2000  # Matches the Socket.IO room member limit
 
 class GroupCreate(BaseModel):
     name: str
     member_ids: List[str]
     created_by: str
 
+    @field_validator("member_ids")
+    @classmethod
+    def dedupe_member_ids(cls, member_ids: List[str]) -> List[str]:
+        # Drop duplicates but keep the caller's order (e.g. creator first)
+        member_ids = list(dict.fromkeys(member_ids))
+        if len(member_ids) > MAX_GROUP_MEMBERS:
+            raise ValueError(f"A group can have at most {MAX_GROUP_MEMBERS} members")
+        return member_ids
+
 class Group(GroupCreate):
     id: str = Field(default_factory=lambda: str(ObjectId()))
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     messages: List[Message] = []
 
-    class Config:
-        json_encoders = {
-            datetime: lambda v: v.isoformat(),
-            ObjectId: str
-        }
-
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, ObjectId):
-            return str(o)
-        if isinstance(o, datetime):
-            return o.isoformat()
-        return json.JSONEncoder.default(self, o)
+def _json_default(o):
+    if isinstance(o, ObjectId):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def dumps(obj) -> bytes:
+    """Serialize to JSON bytes; datetimes are handled natively by orjson"""
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NAIVE_UTC)
+
+class OrjsonModule:
+    """Stand-in for the stdlib json module (python-socketio's `json=` option)"""
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        return dumps(obj).decode()
+
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return orjson.loads(data)
+
+class MongoJSONResponse(JSONResponse):
+    """JSON response for raw MongoDB documents (ObjectId, datetime) in a single orjson pass"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
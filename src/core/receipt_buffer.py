@@ -0,0 +1,149 @@
+from typing import Dict, List, Optional, Set
+import asyncio
+from contextlib import suppress
+import logging
+from bson import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from core.database import messages_collection
+from core.message_buffer import MAX_BULK_CHUNK
+from core.socket_server import sio
+
+# Fields needed to route a read receipt to the right room
+RECEIPT_FIELDS = {"read_by": 1, "type": 1, "group_id": 1, "from_user_id": 1}
+
+class ReceiptBuffer:
+    """Coalesces read receipts (and delete-for-me hides) into one bulk_write (and one lookup) per tick"""
+
+    def __init__(self, flush_interval=0.02):
+        self.pending: Dict[ObjectId, Set[str]] = {}  # message id -> users who read it
+        self.notify: Set[ObjectId] = set()  # messages whose receipt is broadcast
+        self.hidden: Dict[str, Set[ObjectId]] = {}  # user id -> messages deleted for them
+        self.flush_interval = flush_interval
+        self.lock = asyncio.Lock()
+        self._periodic_task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Task] = None  # periodic flush currently running
+        self.stats = {
+            "total_receipts": 0,
+            "total_hides": 0,
+            "successful_flushes": 0,
+            "failed_flushes": 0
+        }
+
+    async def add(self, msg_id: ObjectId, user_id: str) -> None:
+        async with self.lock:
+            self.pending.setdefault(msg_id, set()).add(user_id)
+            self.notify.add(msg_id)
+            self.stats["total_receipts"] += 1
+
+    async def add_many(self, msg_ids: List[ObjectId], user_id: str) -> None:
+        """Queue receipts without a broadcast (used when loading chat history)"""
+        async with self.lock:
+            for msg_id in msg_ids:
+                self.pending.setdefault(msg_id, set()).add(user_id)
+            self.stats["total_receipts"] += len(msg_ids)
+
+    async def hide(self, msg_id: ObjectId, user_id: str) -> None:
+        """Queue a delete-for-me (adds the user to the message's deleted_for)"""
+        async with self.lock:
+            self.hidden.setdefault(user_id, set()).add(msg_id)
+            self.stats["total_hides"] += 1
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pending and not self.hidden:
+                return
+            batch, self.pending = self.pending, {}
+            notify, self.notify = self.notify, set()
+            hidden, self.hidden = self.hidden, {}
+
+        try:
+            ops = [
+                UpdateOne(
+                    {"_id": msg_id},
+                    {"$set": {"status": "read"}, "$addToSet": {"read_by": {"$each": list(user_ids)}}}
+                )
+                for msg_id, user_ids in batch.items()
+            ]
+            # Hides share one update per user, so each user's hides become a single UpdateMany
+            ops.extend(
+                UpdateMany({"_id": {"$in": list(msg_ids)}}, {"$addToSet": {"deleted_for": user_id}})
+                for user_id, msg_ids in hidden.items()
+            )
+            # Unordered, and split into concurrent chunks when a tick carries a large backlog
+            await asyncio.gather(*(
+                messages_collection.bulk_write(ops[i:i + MAX_BULK_CHUNK], ordered=False)
+                for i in range(0, len(ops), MAX_BULK_CHUNK)
+            ))
+
+            # Fetch the merged read_by lists for the broadcast in one query
+            messages = []
+            if notify:
+                messages = await messages_collection.find(
+                    {"_id": {"$in": list(notify)}}, RECEIPT_FIELDS
+                ).to_list(length=len(notify))
+            self.stats["successful_flushes"] += 1
+        except Exception as e:
+            logging.error(f"Error flushing read receipts: {str(e)}")
+            async with self.lock:
+                self.stats["failed_flushes"] += 1
+                # Receipts are idempotent, so merge the batch back for the next tick
+                for msg_id, user_ids in batch.items():
+                    self.pending.setdefault(msg_id, set()).update(user_ids)
+                self.notify.update(notify)
+                for user_id, msg_ids in hidden.items():
+                    self.hidden.setdefault(user_id, set()).update(msg_ids)
+            return
+
+        for message in messages:
+            await self._emit_receipt(message)
+
+    async def _emit_receipt(self, message: Dict) -> None:
+        update = {
+            "type": "read_receipt",
+            "message_id": str(message["_id"]),
+            "read_by": message["read_by"],
+        }
+        if message["type"] == "group":
+            await sio.emit(
+                "message_update", update, room=f'group_{str(message["group_id"])}'
+            )
+        else:
+            await sio.emit(
+                "message_update", update, room=f'user_{message["from_user_id"]}'
+            )
+
+    async def start_periodic_flush(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                # Shielded so stopping the loop never abandons a batch mid-write
+                self._inflight = asyncio.create_task(self.flush())
+                await asyncio.shield(self._inflight)
+            except Exception as e:
+                logging.error(f"Error in periodic receipt flush: {str(e)}")
+
+    def start(self) -> None:
+        """Start the periodic flush loop"""
+        self._periodic_task = asyncio.create_task(self.start_periodic_flush())
+
+    async def close(self) -> None:
+        """Stop the periodic flush, wait for an in-flight flush, then flush what's left"""
+        if self._periodic_task is not None:
+            self._periodic_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._periodic_task
+            self._periodic_task = None
+        if self._inflight is not None:
+            await asyncio.gather(self._inflight, return_exceptions=True)
+        await self.flush()
+
+    def get_stats(self) -> Dict:
+        """Get current receipt buffer statistics"""
+        return {
+            **self.stats,
+            "pending_messages": len(self.pending),
+            "pending_hides": sum(len(msg_ids) for msg_ids in self.hidden.values())
+        }
+
+# Create global receipt buffer instance
+receipt_buffer = ReceiptBuffer(flush_interval=0.02)
@@ -1,8 +1,20 @@
+import os
 import socketio
+from dotenv import load_dotenv
+from core.models import OrjsonModule
+
+load_dotenv()
+
+# With several uvicorn workers, emits must go through Redis so every worker
+# delivers to its own connected clients; a single process can use the default manager
+REDIS_URL = os.getenv("REDIS_URL")
+client_manager = socketio.AsyncRedisManager(REDIS_URL) if REDIS_URL else None
 
 # In src/core/socket_server.py
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=client_manager,
+    json=OrjsonModule,  # orjson-backed packet encoding with ObjectId/datetime support
     cors_allowed_origins="*",
     logger=False,  # Disable logging for better performance
     engineio_logger=False,
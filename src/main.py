@@ -1,30 +1,29 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from contextlib import asynccontextmanager
 
-import json
-
 from datetime import datetime, UTC
 from bson import ObjectId
+from pymongo import ReturnDocument
 import os
 import socketio
+from aiofiles.os import path as aio_path
 import time
 from core.database import (
     messages_collection, 
-    groups_collection, 
     connect_db, 
-    close_db, 
-    init_indexes,
-    get_groups_collection,
-    get_messages_collection
+    close_db
 )
-from core.models import Message, JSONEncoder, MessageType
+from core.models import Message, MessageType, direct_conversation_id
 from core.socket_server import sio
 from core.message_buffer import message_buffer
+from core.receipt_buffer import receipt_buffer
+from core import membership_cache, message_cache
 from routes.group_routes import group_router
-from routes.user_routes import user_router
-import asyncio
+from routes.user_routes import user_router, MAX_UPLOAD_SIZE
+from core.middleware import MaxBodySizeMiddleware, MULTIPART_OVERHEAD
 import logging
 
 UPLOAD_DIR = "uploads"
@@ -40,8 +39,12 @@ async def lifespan(app: FastAPI):
         logger.info("Successfully connected to MongoDB")
         
         # Start message buffer flush task
-        asyncio.create_task(message_buffer.start_periodic_flush())
+        message_buffer.start()
         logger.info("Started message buffer periodic flush")
+
+        # Start read receipt flush task
+        receipt_buffer.start()
+        logger.info("Started read receipt buffer periodic flush")
         
     except Exception as e:
         logger.error(f"Error during startup: {e}")
@@ -52,8 +55,10 @@ async def lifespan(app: FastAPI):
     finally:
         # Shutdown
         try:
-            # Final flush of any remaining messages
-            await message_buffer.flush()
+            # Stop the flush loops, wait for in-flight batches, then flush what's left.
+            # Messages go first so receipts/hides match documents that now exist.
+            await message_buffer.close()
+            await receipt_buffer.close()
             await close_db()
             logger.info("Successfully closed MongoDB connection")
         except Exception as e:
@@ -62,7 +67,7 @@ async def lifespan(app: FastAPI):
 
 
 # Create FastAPI app with lifespan
-app = FastAPI(title="Chat App API", lifespan=lifespan)
+app = FastAPI(title="Chat App API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(
     user_router,
@@ -77,6 +82,8 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+# Bound request bodies (uploads are the largest) before anything buffers them
+app.add_middleware(MaxBodySizeMiddleware, max_body_size=MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD)
 
 
 # Socket.IO event handlers
@@ -84,10 +91,10 @@ app.add_middleware(
 async def connect(sid, environ, auth):
     """Handle client connection with improved error handling"""
     try:
-        logger.info(f"Connection attempt - SID: {sid}, Auth: {auth}")
+        logger.debug("Connection attempt - SID: %s, Auth: %s", sid, auth)
 
         if not auth or "user_id" not in auth:
-            logger.warning(f"Authentication failed - missing user_id")
+            logger.warning("Authentication failed - missing user_id")
             return False
 
         user_id = auth["user_id"]
@@ -98,7 +105,7 @@ async def connect(sid, environ, auth):
         # Join user's personal room
         await sio.enter_room(sid, f"user_{user_id}")
         
-        logger.info(f"User {user_id} connected successfully with sid {sid}")
+        logger.info("User %s connected successfully with sid %s", user_id, sid)
         return True
         
     except Exception as e:
@@ -112,37 +119,39 @@ async def disconnect(sid):
     session = await sio.get_session(sid)
     if session and "user_id" in session:
         user_id = session["user_id"]
-        print(f"User {user_id} disconnected")
-
-        # Leave all rooms
-        for room in sio.rooms(sid):
-            await sio.leave_room(sid, room)
+        logger.info("User %s disconnected", user_id)
+        # python-socketio removes the sid from all of its rooms on disconnect
 
 
 async def send_unread_notification(user_id: str):
     """Send unread messages count to user"""
     try:
-        messages_collection = await get_messages_collection()
-        groups_collection = await get_groups_collection()
-        
-        # Get unread direct messages
-        unread_direct = await messages_collection.count_documents(
-            {"type": "direct", "to_user_id": user_id, "status": "sent"}
-        )
-
-        # Get unread group messages
-        user_groups = await groups_collection.find(
-            {"member_ids": user_id}, {"_id": 1}
-        ).to_list(None)
-
-        group_ids = [str(group["_id"]) for group in user_groups]
-        unread_group = await messages_collection.count_documents(
-            {
-                "type": "group",
-                "group_id": {"$in": group_ids},
-                "read_by": {"$ne": user_id},
-            }
-        )
+        # Count unread direct and group messages in one round-trip: the direct count
+        # runs on messages, the group count is unioned in from the user's groups
+        pipeline = [
+            {"$match": {"type": "direct", "to_user_id": user_id, "status": "sent"}},
+            {"$group": {"_id": "direct", "n": {"$sum": 1}}},
+            {"$unionWith": {
+                "coll": "groups",
+                "pipeline": [
+                    {"$match": {"member_ids": user_id}},
+                    {"$lookup": {
+                        "from": "messages",
+                        "localField": "_id",
+                        "foreignField": "group_id",
+                        "pipeline": [
+                            {"$match": {"type": "group", "read_by": {"$ne": user_id}}},
+                            {"$count": "n"},
+                        ],
+                        "as": "unread",
+                    }},
+                    {"$group": {"_id": "group", "n": {"$sum": {"$sum": "$unread.n"}}}},
+                ],
+            }},
+        ]
+        counts = {doc["_id"]: doc["n"] async for doc in messages_collection.aggregate(pipeline)}
+        unread_direct = counts.get("direct", 0)
+        unread_group = counts.get("group", 0)
 
         if unread_direct > 0 or unread_group > 0:
             notification = {
@@ -167,15 +176,12 @@ async def join_group(sid, group_id):
             return
 
         user_id = session["user_id"]
-        groups_collection = await get_groups_collection()
-        group = await groups_collection.find_one({"_id": ObjectId(group_id)})
-
-        if not group or user_id not in group["member_ids"]:
+        if not await membership_cache.is_member(group_id, user_id):
             return
 
         # Join the group's room
         await sio.enter_room(sid, f"group_{group_id}")
-        logger.info(f"User {user_id} joined group {group_id}")
+        logger.info("User %s joined group %s", user_id, group_id)
     except Exception as e:
         logger.error(f"Error in join_group handler: {str(e)}")
 
@@ -195,7 +201,6 @@ async def send_message(sid, data):
             return
 
         user_id = session["user_id"]
-        groups_collection = await get_groups_collection()
 
         # Prepare message data
         message_data = {
@@ -214,50 +219,55 @@ async def send_message(sid, data):
             # Validate media file exists
             if data["media_url"]:
                 file_path = os.path.join(UPLOAD_DIR, os.path.basename(data["media_url"]))
-                if not os.path.exists(file_path):
+                # Stat off the event loop thread
+                if not await aio_path.exists(file_path):
                     raise Exception("Media file not found")
 
         message = Message(**message_data)
 
         if message.type == "group":
             group_id = ObjectId(data["to"])
-            group = await groups_collection.find_one({"_id": group_id})
-
-            if not group or user_id not in group["member_ids"]:
+            if not await membership_cache.is_member(group_id, user_id):
                 return
 
             # Prepare message for database
-            message_dict = message.dict()
+            message_dict = message.model_dump(by_alias=True)
             message_dict["group_id"] = group_id
             message_dict["read_by"] = [user_id]
             
             # Add to buffer for batch processing
             await message_buffer.add_message(message_dict)
+            message_cache.invalidate(message_cache.conversation_key("group", user_id, group_id))
             
-            # Convert to JSON-serializable format for Socket.IO emission
-            emit_message = json.loads(json.dumps(message_dict, cls=JSONEncoder))
+            # The Socket.IO server serializes ObjectId/datetime itself (orjson)
+            emit_message = message_dict
             if emit_message.get("media_url"):
-                emit_message["media_url"] = f"/uploads/{os.path.basename(emit_message['media_url'])}"
+                emit_message = {**message_dict, "media_url": f"/uploads/{os.path.basename(message_dict['media_url'])}"}
 
             # Emit immediately to all group members
             await sio.emit("message", emit_message, room=f"group_{str(group_id)}")
 
         else:
             # Handle direct message
-            message_dict = message.dict()
-            message_dict["to_user_id"] = data["to"]
+            message_dict = message.model_dump(by_alias=True)
+            # User ids are strings everywhere else (rooms, REST paths); clients may send numbers
+            to_user_id = str(data["to"])
+            message_dict["to_user_id"] = to_user_id
+            message_dict["conversation_id"] = direct_conversation_id(user_id, to_user_id)
             
             # Add to buffer for batch processing
             await message_buffer.add_message(message_dict)
+            message_cache.invalidate(message_cache.conversation_key("direct", user_id, to_user_id))
             
-            # Convert to JSON-serializable format for Socket.IO emission
-            emit_message = json.loads(json.dumps(message_dict, cls=JSONEncoder))
+            # The Socket.IO server serializes ObjectId/datetime itself (orjson)
+            emit_message = message_dict
             if emit_message.get("media_url"):
-                emit_message["media_url"] = f"/uploads/{os.path.basename(emit_message['media_url'])}"
+                emit_message = {**message_dict, "media_url": f"/uploads/{os.path.basename(message_dict['media_url'])}"}
 
-            # Emit immediately to both sender and recipient
-            await sio.emit("message", emit_message, room=f'user_{data["to"]}')
-            await sio.emit("message", emit_message, room=f"user_{user_id}")
+            # Emit immediately to the recipient; the sender gets the assigned
+            # id and timestamp back as the Socket.IO ack instead of an echo
+            await sio.emit("message", emit_message, room=f'user_{to_user_id}')
+            return {"_id": str(message_dict["_id"]), "timestamp": message_dict["timestamp"].isoformat()}
 
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
@@ -273,35 +283,35 @@ async def mark_read(sid, data):
             return
 
         user_id = session["user_id"]
-        messages_collection = await get_messages_collection()
         msg_id = ObjectId(data["message_id"])
 
-        await messages_collection.update_one(
-            {"_id": msg_id},
-            {"$set": {"status": "read"}, "$addToSet": {"read_by": user_id}},
-        )
-
-        # Notify other users about read status
-        message = await messages_collection.find_one({"_id": msg_id})
-        if message:
-            update = {
-                "type": "read_receipt",
-                "message_id": str(msg_id),
-                "read_by": message["read_by"],
-            }
-            if message["type"] == "group":
-                await sio.emit(
-                    "message_update", update, room=f'group_{str(message["group_id"])}'
-                )
-            else:
-                await sio.emit(
-                    "message_update", update, room=f'user_{message["from_user_id"]}'
-                )
+        # Coalesced into a bulk write; the receipt is broadcast once it's persisted
+        await receipt_buffer.add(msg_id, user_id)
 
     except Exception as e:
         logger.error(f"Error marking message as read: {str(e)}")
 
 
+# Fields needed to route edit/delete notifications
+MESSAGE_ROUTING_FIELDS = {"type": 1, "group_id": 1, "from_user_id": 1, "to_user_id": 1, "content": 1}
+
+
+def invalidate_conversation(message: dict):
+    """Drop cached chat history for the conversation a message belongs to"""
+    other_id = message["group_id"] if message["type"] == "group" else message["to_user_id"]
+    message_cache.invalidate(
+        message_cache.conversation_key(message["type"], message["from_user_id"], other_id)
+    )
+
+
+async def emit_ownership_error(sid, msg_id: ObjectId, action: str):
+    """Report why a sender-only update matched nothing (only hit on the failure path)"""
+    if await messages_collection.find_one({"_id": msg_id}, {"_id": 1}):
+        await sio.emit("error", {"message": f"Not authorized to {action} this message"}, room=sid)
+    else:
+        await sio.emit("error", {"message": "Message not found"}, room=sid)
+
+
 @sio.event
 async def edit_message(sid, data):
     """Handle editing messages"""
@@ -312,30 +322,23 @@ async def edit_message(sid, data):
             return
 
         user_id = session["user_id"]
-        messages_collection = await get_messages_collection()
         msg_id = ObjectId(data["message_id"])
         new_content = data["content"]
 
-        # Get the message to check ownership
-        message = await messages_collection.find_one({"_id": msg_id})
+        # Update the message; only the sender matches, so ownership is enforced atomically
+        message = await messages_collection.find_one_and_update(
+            {"_id": msg_id, "from_user_id": user_id},
+            {"$set": {"content": new_content}},
+            projection=MESSAGE_ROUTING_FIELDS,
+            return_document=ReturnDocument.BEFORE,
+        )
         if not message:
-            await sio.emit("error", {"message": "Message not found"}, room=sid)
+            await emit_ownership_error(sid, msg_id, "edit")
             return
 
-        # Only allow editing if user is the message sender
-        if message["from_user_id"] != user_id:
-            await sio.emit(
-                "error", {"message": "Not authorized to edit this message"}, room=sid
-            )
-            return
+        if message["content"] != new_content:
+            invalidate_conversation(message)
 
-        # Update the message
-        result = await messages_collection.update_one(
-            {"_id": msg_id},
-            {"$set": {"content": new_content}}
-        )
-        
-        if result.modified_count > 0:
             # Prepare update notification
             update = {
                 "type": "message_edit",
@@ -372,26 +375,19 @@ async def delete_message(sid, data):
             return
 
         user_id = session["user_id"]
-        messages_collection = await get_messages_collection()
         msg_id = ObjectId(data["message_id"])
         delete_for = data.get("delete_for", "everyone")
 
-        # Get the message to check ownership
-        message = await messages_collection.find_one({"_id": msg_id})
-        if not message:
-            await sio.emit("error", {"message": "Message not found"}, room=sid)
-            return
-
         if delete_for == "everyone":
-            # Only allow deletion if user is the message sender
-            if message["from_user_id"] != user_id:
-                await sio.emit(
-                    "error", {"message": "Not authorized to delete this message"}, room=sid
-                )
+            # Delete the message; only the sender matches, so ownership is enforced atomically
+            message = await messages_collection.find_one_and_delete(
+                {"_id": msg_id, "from_user_id": user_id},
+                projection=MESSAGE_ROUTING_FIELDS,
+            )
+            if not message:
+                await emit_ownership_error(sid, msg_id, "delete")
                 return
-
-            # Delete the message
-            await messages_collection.delete_one({"_id": msg_id})
+            invalidate_conversation(message)
 
             # Prepare deletion notification
             notification = {
@@ -413,10 +409,13 @@ async def delete_message(sid, data):
 
         else:  # delete_for == "me"
             # Add user to deleted_for array
-            await messages_collection.update_one(
+            result = await messages_collection.update_one(
                 {"_id": msg_id},
                 {"$addToSet": {"deleted_for": user_id}}
             )
+            if result.matched_count == 0:
+                await sio.emit("error", {"message": "Message not found"}, room=sid)
+                return
             # Only notify the user who deleted for themselves
             await sio.emit("message_deleted", {
                 "type": "message_hidden",
@@ -448,6 +447,7 @@ if __name__ == "__main__":
         reload=False,  # Disable reload in production
         workers=4,    # Increased workers (2 * num_cores + 1)
         loop="uvloop",
+        http="httptools",  # C HTTP/1.1 parser instead of pure-Python h11
         limit_concurrency=5000,  # Increased concurrency limit
         backlog=8192,  # Increased connection backlog
         timeout_keep_alive=30,  # Increased keep-alive timeout
@@ -2,25 +2,29 @@ from fastapi import HTTPException, APIRouter
 from bson import ObjectId
 from datetime import datetime, UTC
 from core.models import GroupCreate
-from core.database import get_groups_collection, get_messages_collection
-from core.models import JSONEncoder
+from core.database import groups_collection, messages_collection
+from core.models import MongoJSONResponse
 from core.socket_server import sio  
-import json
+from core import membership_cache
 from typing import Optional
 import logging
+import asyncio
+import re
 
 logger = logging.getLogger(__name__)
 group_router = APIRouter(tags=["Group"])
 
+SEARCH_LIMIT = 50  # Max groups returned by search_groups
+
 @group_router.post("/group/{group_id}/{user_id}")
 async def add_user_to_group(group_id: str, user_id: str):
     """Add a user to a group"""
     try:
-        groups_collection = await get_groups_collection()
         await groups_collection.update_one(
             {"_id": ObjectId(group_id)},
             {"$addToSet": {"member_ids": user_id}}
         )
+        await membership_cache.invalidate_group(group_id)
         return {"message": "User added to group"}
     except Exception as e:
         logger.error(f"Error adding user to group: {str(e)}")
@@ -30,10 +34,6 @@ async def add_user_to_group(group_id: str, user_id: str):
 async def create_group(group_data: GroupCreate):
     """Create a new group chat"""
     try:
-        groups_collection = await get_groups_collection()
-        
-        group_data.member_ids = list(set(group_data.member_ids))
-        
         group = {
             "name": group_data.name,
             "member_ids": group_data.member_ids,
@@ -52,10 +52,13 @@ async def create_group(group_data: GroupCreate):
             "timestamp": datetime.now(UTC).isoformat()
         }
         
-        for member_id in group_data.member_ids:
-            await sio.emit('notification', notification, room=f'user_{member_id}')
+        # One emit to all members' rooms: the payload is encoded once and fanned out by the manager.
+        # Skip it when there is nobody to notify: emit(to=[]) falls back to a broadcast to everyone.
+        rooms = [f'user_{member_id}' for member_id in group_data.member_ids]
+        if rooms:
+            await sio.emit('notification', notification, to=rooms)
         
-        return json.loads(json.dumps(group, cls=JSONEncoder))
+        return MongoJSONResponse(group)
     except Exception as e:
         logger.error(f"Error creating group: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -64,9 +67,8 @@ async def create_group(group_data: GroupCreate):
 async def get_user_groups(user_id: str):
     """Get all groups for a user"""
     try:
-        groups_collection = await get_groups_collection()
         groups = await groups_collection.find({"member_ids": user_id}).to_list(length=None)
-        return json.loads(json.dumps(groups, cls=JSONEncoder))
+        return MongoJSONResponse(groups)
     except Exception as e:
         logger.error(f"Error getting user groups: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -75,14 +77,14 @@ async def get_user_groups(user_id: str):
 async def search_groups(name: str):
     """Get group by name"""
     try:
-        groups_collection = await get_groups_collection()
-        name_pattern = {"$regex": name, "$options": "i"}
-        groups = await groups_collection.find({"name": name_pattern}).to_list(length=None)
+        # Escaped, anchored prefix match; results are capped for this public endpoint
+        name_pattern = {"$regex": f"^{re.escape(name)}", "$options": "i"}
+        groups = await groups_collection.find({"name": name_pattern}).limit(SEARCH_LIMIT).to_list(length=SEARCH_LIMIT)
         
         if not groups:
             raise HTTPException(status_code=404, detail="Group not found")
         
-        return json.loads(json.dumps(groups, cls=JSONEncoder))
+        return MongoJSONResponse(groups)
     except Exception as e:
         logger.error(f"Error searching groups: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -91,18 +93,18 @@ async def search_groups(name: str):
 async def delete_group(group_id: str):
     """Delete the group and its associated messages"""
     try:
-        groups_collection = await get_groups_collection()
-        messages_collection = await get_messages_collection()
-        
         group_oid = ObjectId(group_id)
         group = await groups_collection.find_one({"_id": group_oid})
         
         if not group:
             raise HTTPException(status_code=404, detail="Group not found")
         
-        # Delete group and its messages
-        await groups_collection.delete_one({"_id": group_oid})
-        await messages_collection.delete_many({"type": "group", "to": group_id})
+        # Delete group and its messages concurrently
+        await asyncio.gather(
+            groups_collection.delete_one({"_id": group_oid}),
+            messages_collection.delete_many({"type": "group", "group_id": group_oid}),
+            membership_cache.invalidate_group(group_id)
+        )
         
         return {"message": "Group deleted successfully"}
     except Exception as e:
@@ -113,8 +115,6 @@ async def delete_group(group_id: str):
 async def remove_from_group(group_id: str, user_id: str, admin_id: Optional[str] = None):
     """Remove a user from a group"""
     try:
-        groups_collection = await get_groups_collection()
-        
         group_oid = ObjectId(group_id)
         group = await groups_collection.find_one({"_id": group_oid})
         
@@ -142,6 +142,7 @@ async def remove_from_group(group_id: str, user_id: str, admin_id: Optional[str]
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Failed to remove user from group")
+        await membership_cache.invalidate_group(group_id)
         
         notification = {
             "type": "group_notification",
@@ -151,9 +152,10 @@ async def remove_from_group(group_id: str, user_id: str, admin_id: Optional[str]
             "timestamp": datetime.now(UTC).isoformat()
         }
         
-        for member_id in group['member_ids']:
-            if member_id != user_id:
-                await sio.emit('notification', notification, room=f'user_{member_id}')
+        # emit(to=[]) would broadcast to everyone, so only emit when members remain
+        rooms = [f'user_{member_id}' for member_id in group['member_ids'] if member_id != user_id]
+        if rooms:
+            await sio.emit('notification', notification, to=rooms)
         
         return {
             "message": "Successfully removed from group",
@@ -1,120 +1,125 @@
 # FastAPI routes for REST endpoints
-from fastapi import HTTPException, APIRouter, UploadFile, File
+from fastapi import HTTPException, APIRouter, UploadFile, File, Request, Response, Query
 from bson import ObjectId
+from pymongo.errors import WaitQueueTimeoutError
 
-from core.database import messages_collection, get_db_stats
-from core.models import JSONEncoder
+from core.database import messages_collection, get_db_stats, get_pool_stats
+from core.models import dumps, direct_conversation_id
 import os
 from fastapi.responses import FileResponse
-import json
 import aiofiles
+import aiofiles.os
 import uuid
+import hashlib
+import gzip
 from datetime import datetime, UTC
-from core.database import groups_collection
 from core.socket_server import sio
-from pymongo import UpdateMany
-import asyncio
 from core.message_buffer import message_buffer
+from core.receipt_buffer import receipt_buffer
+from core import membership_cache, message_cache
 
 user_router = APIRouter(tags=["User"])
 
 # Add these constants at the top of the file
 UPLOAD_DIR = "uploads"
 MAX_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB limit
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_HISTORY_LIMIT = 500  # Largest page of messages get_messages returns
 ALLOWED_EXTENSIONS = {
     "image": (".jpg", ".jpeg", ".png", ".gif"),
     "video": (".mp4", ".mov", ".avi"),
     "file": (".pdf", ".doc", ".docx"),
     "audio": (".mp3", ".wav", ".ogg", ".m4a", ".webm"),  # Add audio formats
 }
+# Reverse lookup so classifying an upload is a single dict hit
+EXTENSION_TO_TYPE = {ext: type_ for type_, extensions in ALLOWED_EXTENSIONS.items() for ext in extensions}
+
+# Test chat page (src/test_chat.html), loaded and compressed once at import
+CHAT_HTML_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_chat.html")
+with open(CHAT_HTML_PATH, "rb") as f:
+    CHAT_HTML = f.read()
+CHAT_HTML_GZ = gzip.compress(CHAT_HTML)
 
 # Create uploads directory if it doesn't exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
 @user_router.get("/messages/{user_id}/{other_id}")
-async def get_messages(user_id: str, other_id: str, message_type: str = "direct", limit: int = 50):
+async def get_messages(
+    user_id: str,
+    other_id: str,
+    message_type: str = "direct",
+    limit: int = Query(50, ge=1, le=MAX_HISTORY_LIMIT),
+):
     """Get chat history for direct messages or group messages"""
     try:
-        # Add basic connection management
-        for attempt in range(3):  # Try 3 times
-            try:
-                # Add caching for frequent requests
-                cache_key = f"{user_id}:{other_id}:{message_type}:{limit}"
-                
-                # Create index hint for faster queries
-                index_hint = None
-                if message_type == "group":
-                    query = {"type": "group", "group_id": ObjectId(other_id)}
-                    index_hint = "group_messages"
-                else:
-                    query = {
-                        "type": "direct",
-                        "$or": [
-                            {"from_user_id": user_id, "to_user_id": other_id},
-                            {"from_user_id": other_id, "to_user_id": user_id},
-                        ],
-                    }
-                    index_hint = "user_messages"
-
-                # Use projection to limit fields returned
-                projection = {
-                    "_id": 1,
-                    "content": 1,
-                    "from_user_id": 1,
-                    "timestamp": 1,
-                    "type": 1,
-                    "media_url": 1,
-                    "status": 1
-                }
-
-                # Fetch messages with optimized query
-                cursor = messages_collection.find(
-                    query,
-                    projection=projection,
-                    # Add timeout to prevent long-running queries
-                    max_time_ms=5000
-                ).sort("timestamp", -1).limit(limit)
-                
-                if index_hint:
-                    cursor = cursor.hint(index_hint)
-                    
-                messages = await cursor.to_list(length=None)
-                break  # If successful, break the retry loop
-            except Exception as e:
-                if "Timed out while checking out a connection" in str(e) and attempt < 2:
-                    await asyncio.sleep(0.5 * (attempt + 1))  # Progressive backoff
-                    continue
-                raise  # Re-raise if all attempts failed or different error
-
-        # Batch update read status
-        if messages:
-            update_ops = []
-            if message_type == "group":
-                unread_ids = [msg["_id"] for msg in messages if user_id not in msg.get("read_by", [])]
-                if unread_ids:
-                    update_ops.append(UpdateMany(
-                        {"_id": {"$in": unread_ids}},
-                        {"$addToSet": {"read_by": user_id}}
-                    ))
-            else:
-                unread_ids = [msg["_id"] for msg in messages 
-                            if msg.get("to_user_id") == user_id and msg.get("status") != "read"]
-                if unread_ids:
-                    update_ops.append(UpdateMany(
-                        {"_id": {"$in": unread_ids}},
-                        {"$set": {"status": "read"}}
-                    ))
-
-            # Execute batch updates if needed
-            if update_ops:
-                await messages_collection.bulk_write(update_ops)
-
-        return json.loads(json.dumps(messages, cls=JSONEncoder))
+        # Serve repeated polls of the same chat from the short-lived cache
+        conversation = message_cache.conversation_key(message_type, user_id, other_id)
+        cache_key = f"{user_id}:{other_id}:{message_type}:{limit}"
+        cached = message_cache.get(conversation, cache_key)
+        if cached is not None:
+            return Response(cached, media_type="application/json")
+
+        # Create index hint for faster queries
+        index_hint = None
+        if message_type == "group":
+            query = {"type": "group", "group_id": ObjectId(other_id)}
+            index_hint = "group_history"
+        else:
+            # Both directions share one key, so this is a single index range
+            query = {
+                "type": "direct",
+                "conversation_id": direct_conversation_id(user_id, other_id),
+            }
+            index_hint = "direct_conversation_id"
+
+        # Use projection to limit fields returned
+        projection = {
+            "_id": 1,
+            "content": 1,
+            "from_user_id": 1,
+            "timestamp": 1,
+            "type": 1,
+            "media_url": 1,
+            "status": 1,
+            # Needed to work out which messages are still unread; read_by itself can hold
+            # thousands of ids per group message, so only whether this user is in it is returned
+            "to_user_id": 1,
+            "read_by_user": {"$in": [user_id, {"$ifNull": ["$read_by", []]}]}
+        }
+
+        # Fetch messages with optimized query
+        cursor = messages_collection.find(
+            query,
+            projection=projection,
+            # Add timeout to prevent long-running queries
+            max_time_ms=5000
+        ).sort("timestamp", -1).limit(limit).batch_size(limit)
+
+        if index_hint:
+            cursor = cursor.hint(index_hint)
+
+        # The whole page comes back in the first reply, no getMore round trips
+        messages = await cursor.to_list(length=limit)
+
+        # Mark as read off the request path; the receipt buffer batches the writes
+        if message_type == "group":
+            unread_ids = [msg["_id"] for msg in messages if not msg["read_by_user"]]
+        else:
+            unread_ids = [msg["_id"] for msg in messages
+                          if msg.get("to_user_id") == user_id and msg.get("status") != "read"]
+        if unread_ids:
+            await receipt_buffer.add_many(unread_ids, user_id)
+
+        # Serialize once (ObjectId/datetime included) and cache the encoded body
+        body = dumps(messages)
+        message_cache.put(conversation, cache_key, body)
+        return Response(body, media_type="application/json")
         
     except Exception as e:
         print(f"Error getting messages: {str(e)}")
-        if "Timed out while checking out a connection" in str(e):
+        if isinstance(e, WaitQueueTimeoutError):
+            # Pool exhausted: tell the client to back off rather than retrying here
             raise HTTPException(
                 status_code=503,
                 detail="Server is experiencing high load, please try again"
@@ -123,42 +128,53 @@ async def get_messages(user_id: str, other_id: str, message_type: str = "direct"
 
 
 @user_router.get("/")
-async def get_chat():
-    # Get the absolute path to test_chat.html
-    html_path = "/home/muzammil/Downloads/chat_app/src/test_chat.html"
-    return FileResponse(html_path)
+async def get_chat(request: Request):
+    """Serve the test chat page, gzipped when the client accepts it"""
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(CHAT_HTML_GZ, media_type="text/html", headers=headers)
+    return Response(CHAT_HTML, media_type="text/html", headers=headers)
 
 
 @user_router.post("/upload/")
 async def upload_file(file: UploadFile = File(...)):
     """Handle file uploads for chat messages"""
     try:
-        # Check file size
-        content = await file.read()
-        if len(content) > MAX_UPLOAD_SIZE:
-            raise HTTPException(
-                status_code=413,
-                detail=f"File too large. Maximum size is {MAX_UPLOAD_SIZE/1024/1024}MB",
-            )
-
-        # Generate unique filename
+        # Check the type before touching the disk
         ext = os.path.splitext(file.filename)[1].lower()
-        filename = f"{uuid.uuid4()}{ext}"
-        file_path = os.path.join(UPLOAD_DIR, filename)
-
-        # Determine content type
-        content_type = None
-        for type_, extensions in ALLOWED_EXTENSIONS.items():
-            if ext in extensions:
-                content_type = type_
-                break
-
+        content_type = EXTENSION_TO_TYPE.get(ext)
         if not content_type:
             raise HTTPException(status_code=400, detail="Unsupported file type")
 
-        # Save file
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(content)
+        # Stream to a temporary file in chunks, hashing and enforcing the size limit as we go
+        tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4()}.part")
+        hasher = hashlib.blake2b(digest_size=16)
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_SIZE:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File too large. Maximum size is {MAX_UPLOAD_SIZE/1024/1024}MB",
+                        )
+                    hasher.update(chunk)
+                    await f.write(chunk)
+
+            # Content-addressed name: identical uploads share one stored file
+            filename = f"{hasher.hexdigest()}{ext}"
+            file_path = os.path.join(UPLOAD_DIR, filename)
+            if await aiofiles.os.path.exists(file_path):
+                await aiofiles.os.remove(tmp_path)
+            else:
+                await aiofiles.os.replace(tmp_path, file_path)
+        except Exception:
+            # Don't leave partial uploads behind
+            if await aiofiles.os.path.exists(tmp_path):
+                await aiofiles.os.remove(tmp_path)
+            raise
 
         # Generate URL for the uploaded file
         file_url = f"/uploads/{filename}"
@@ -167,20 +183,30 @@ async def upload_file(file: UploadFile = File(...)):
             "url": file_url,
             "content_type": content_type,
             "filename": file.filename,
-            "size": len(content),
+            "size": size,
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # Add this to serve uploaded files
 @user_router.get("/uploads/{filename}")
-async def get_upload(filename: str):
+async def get_upload(filename: str, request: Request):
     file_path = os.path.join(UPLOAD_DIR, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
+
+    # Uploads are named by their content hash and never rewritten, so the name is a strong validator
+    headers = {
+        "ETag": f'"{os.path.splitext(filename)[0]}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, headers=headers)
 
 
 @user_router.get("/health/db")
@@ -192,45 +218,58 @@ async def database_health():
     return stats
 
 
+@user_router.get("/health/db-pool")
+async def database_pool_health():
+    """Get MongoDB connection pool statistics"""
+    return get_pool_stats()
+
+
+# Fields needed to authorize and route a deletion
+DELETE_ROUTING_FIELDS = {"type": 1, "group_id": 1, "from_user_id": 1, "to_user_id": 1}
+
+
 @user_router.delete("/messages/{message_id}")
 async def delete_message(message_id: str, user_id: str, delete_for: str = "me"):
     """Delete a specific message"""
     try:
         message_oid = ObjectId(message_id)
         
-        # Get message details first
-        message = await messages_collection.find_one({"_id": message_oid})
+        # Get message details first (only what routing the deletion needs)
+        message = await messages_collection.find_one({"_id": message_oid}, DELETE_ROUTING_FIELDS)
         if not message:
             raise HTTPException(status_code=404, detail="Message not found")
             
         if delete_for == "me":
-            # Add user to deleted_for array
-            result = await messages_collection.update_one(
-                {"_id": message_oid},
-                {"$addToSet": {"deleted_for": user_id}}
-            )
+            # Add user to deleted_for array; batched with other hides and read receipts
+            await receipt_buffer.hide(message_oid, user_id)
         elif delete_for == "everyone":
             # Only allow sender to delete for everyone
             if message["from_user_id"] != user_id:
                 raise HTTPException(status_code=403, detail="Only message sender can delete for everyone")
                 
-            result = await messages_collection.delete_one({"_id": message_oid})
+            await messages_collection.delete_one({"_id": message_oid})
+            is_group = message["type"] == "group"
+            chat_id = message["group_id"] if is_group else message["to_user_id"]
+            message_cache.invalidate(
+                message_cache.conversation_key(message["type"], message["from_user_id"], chat_id)
+            )
             
             # Notify other users about deletion
             notification = {
                 "type": "message_deleted",
                 "message_id": message_id,
                 "chat_type": message["type"],
-                "chat_id": message["group_id"] if message["type"] == "group" else message["to_user_id"],
+                "chat_id": chat_id,
                 "timestamp": datetime.now(UTC).isoformat()
             }
             
-            if message["type"] == "group":
-                group = await groups_collection.find_one({"_id": ObjectId(message["group_id"])})
-                if group:
-                    for member_id in group["member_ids"]:
-                        if member_id != user_id:
-                            await sio.emit('message_deleted', notification, room=f'user_{member_id}')
+            if is_group:
+                member_ids = await membership_cache.get_member_ids(chat_id)
+                rooms = [f'user_{member_id}' for member_id in member_ids if member_id != user_id]
+                # Guard on the filtered list: emit(to=[]) falls back to room=None, i.e. a broadcast to everyone
+                if rooms:
+                    # One emit to all members' rooms: the payload is encoded once and fanned out by the manager
+                    await sio.emit('message_deleted', notification, to=rooms)
             else:
                 other_user = message["to_user_id"] if message["from_user_id"] == user_id else message["from_user_id"]
                 await sio.emit('message_deleted', notification, room=f'user_{other_user}')
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+# The app is run from src/ and imports its modules as core.*; the client is
+# built at import but only connects on the first command, so any URL will do.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+
+from core import message_buffer as message_buffer_module  # noqa: E402
+from core.message_buffer import MessageBuffer  # noqa: E402
+
+
+class FakeCollection:
+    """Stands in for the write-concern collection the buffer inserts into"""
+
+    def __init__(self, block=False):
+        self.block = block
+        self.writes = []
+
+    async def bulk_write(self, ops, **kwargs):
+        if self.block:
+            await asyncio.Event().wait()
+        self.writes.append(ops)
+
+
+def make_buffer(collection):
+    buffer = MessageBuffer(batch_size=100)
+    buffer._wc_collection = collection
+    return buffer
+
+
+def test_successful_flush_neither_sleeps_nor_counts_a_retry(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        sleeps.append(delay)
+
+    async def run():
+        buffer = make_buffer(FakeCollection())
+        await buffer.add_message({"content": "hi"})
+        monkeypatch.setattr(message_buffer_module.asyncio, "sleep", fake_sleep)
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(run())
+
+    assert sleeps == []
+    assert buffer.stats["retry_count"] == 0
+    assert buffer.stats["successful_flushes"] == 1
+    assert len(buffer._wc_collection.writes) == 1
+    assert not buffer.messages
+
+
+def test_cancelled_probe_reopens_the_breaker():
+    async def run():
+        buffer = make_buffer(FakeCollection(block=True))
+        await buffer.add_message({"content": "hi"})
+
+        breaker = buffer.circuit_breaker
+        breaker.state = "open"
+        breaker.last_failure_time = time.monotonic() - breaker.reset_timeout - 1
+
+        task = asyncio.create_task(buffer._perform_bulk_insert(buffer.messages))
+        while breaker.state != "half_open":
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return breaker
+
+    breaker = asyncio.run(run())
+
+    assert breaker.state == "open"
+    assert not breaker.probe_due()